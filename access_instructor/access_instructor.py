@@ -1,12 +1,32 @@
 import configparser
+import cProfile
+import gzip
+import io
+import json
 import os
+import pstats
 import sys
-from glob import glob
+import threading
+import time
+import tracemalloc
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from glob import glob, has_magic
 from pathlib import Path
-from string import punctuation
 
 import click
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+from urllib3.util.request import ACCEPT_ENCODING
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 config = configparser.ConfigParser()
 config_path = os.environ.get("ACCESS_INSTRUCTOR_CLIENT_CONFIG_FILE")
@@ -20,14 +40,547 @@ if not config_path:
 
 config.read(config_path)
 
-API_URL = config["DEFAULT"]["API_URL"]
-TOKEN = config["DEFAULT"]["TOKEN"]
+# Named profile (config section) to use, sections inherit values from [DEFAULT].
+# It is loaded on first use so -P can pick a profile before anything is read.
+PROFILE = os.environ.get("ACCESS_INSTRUCTOR_CLIENT_PROFILE", "DEFAULT")
+profile_loaded = False
+TOKEN = None
+
+# API_URL may list several replicas, requests are spread across the healthy ones
+endpoints = []
+endpoints_lock = threading.Lock()
+endpoints_check_lock = threading.Lock()
+endpoints_checked = False
+
+CONNECT_TIMEOUT = 5
+# Seconds to wait for a response, so a replica that hangs is failed over
+READ_TIMEOUT = 60
+HEALTH_PATH = "/"
+# Seconds an endpoint is skipped for after failing
+ENDPOINT_COOLDOWN = 30
+
+# Endpoints that are safe to resend to another replica after a failure,
+# others are only resent if the request never reached the server
+IDEMPOTENT_ENDPOINTS = {"/rule/find", "/licence/find", "/rule/update"}
+RETRY_STATUSES = {502, 503, 504}
+
+# Request body compression ("gzip", "zstd" or "none") and compact path
+# encoding ("front-coded" or "plain"). Requests stay plain JSON until the
+# server advertises support in Accept-Encoding / Accept-Paths-Encoding.
+COMPRESSION = "none"
+PATH_ENCODING = "plain"
+COMPRESS_MIN_BYTES = 1024
+
+COMPRESSORS = {"gzip": gzip.compress}
+
+if zstandard:
+    COMPRESSORS["zstd"] = zstandard.ZstdCompressor().compress
+
+# Local snapshot of rules ordered by expiry date, used by the expiring command
+RULE_CACHE = None
+RULE_CACHE_MAX_AGE = timedelta(hours=24)
+
+# Endpoints that change rules, invalidating the expiry snapshot
+RULE_WRITE_ENDPOINTS = {"/rule/add", "/rule/update", "/rule/remove"}
+
+# Request encodings the server has advertised during this run
+advertised_encodings = set()
+
+# Pooled connections shared by all requests, sized for concurrent bulk commands
+POOL_SIZE = 16
+
+session = requests.Session()
+
+
+def load_profile(profile):
+    """Read the API endpoints, token and client settings of a named config profile"""
+    global PROFILE, profile_loaded, TOKEN, endpoints_checked
+    global CONNECT_TIMEOUT, READ_TIMEOUT, HEALTH_PATH, ENDPOINT_COOLDOWN
+    global COMPRESSION, PATH_ENCODING, COMPRESS_MIN_BYTES
+    global RULE_CACHE, RULE_CACHE_MAX_AGE, POOL_SIZE
+
+    if profile != "DEFAULT" and not config.has_section(profile):
+        raise click.ClickException(f"No [{profile}] section in {config_path}")
+
+    settings = config[profile]
+    urls = settings.get("API_URL", "").replace(",", " ").split()
+
+    if not urls:
+        raise click.ClickException(f"No API_URL for profile [{profile}] in {config_path}")
+
+    PROFILE = profile
+    TOKEN = settings.get("TOKEN")
+
+    CONNECT_TIMEOUT = settings.getfloat("CONNECT_TIMEOUT", 5)
+    READ_TIMEOUT = settings.getfloat("READ_TIMEOUT", 60)
+    HEALTH_PATH = settings.get("HEALTH_PATH", "/")
+    ENDPOINT_COOLDOWN = settings.getfloat("ENDPOINT_COOLDOWN", 30)
+
+    COMPRESSION = settings.get("COMPRESSION", "none")
+    PATH_ENCODING = settings.get("PATH_ENCODING", "plain")
+    COMPRESS_MIN_BYTES = settings.getint("COMPRESS_MIN_BYTES", 1024)
+    advertised_encodings.clear()
+
+    if COMPRESSION != "none" and COMPRESSION not in COMPRESSORS:
+        click.echo(
+            f"Warning: COMPRESSION = {COMPRESSION} is unknown or its library is not installed, "
+            "request bodies will not be compressed",
+            err=True,
+        )
+
+    if PATH_ENCODING not in ("plain", "front-coded"):
+        click.echo(
+            f"Warning: PATH_ENCODING = {PATH_ENCODING} is unknown, paths will be sent as plain JSON",
+            err=True,
+        )
+
+    # Each profile gets its own snapshot so they never serve each other's rules
+    RULE_CACHE = settings.get(
+        "RULE_CACHE",
+        os.path.join(Path.home(), ".cache", "access_instructor", f"rules-{profile}.json"),
+    )
+    RULE_CACHE_MAX_AGE = timedelta(hours=settings.getint("RULE_CACHE_MAX_AGE", 24))
+
+    POOL_SIZE = settings.getint("POOL_SIZE", 16)
+    session.mount("http://", HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE))
+    session.mount("https://", HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE))
+
+    with endpoints_lock:
+        endpoints[:] = [
+            {"url": url, "outstanding": 0, "latency": 0.0, "down_until": 0.0}
+            for url in urls
+        ]
+        endpoints_checked = False
+
+    profile_loaded = True
+
+
+def ensure_profile():
+    """Load the selected profile if nothing has been read from it yet"""
+    if not profile_loaded:
+        load_profile(PROFILE)
+
+
+def profile_callback(ctx, param, value):
+    """Select the given config profile, it is loaded when first needed"""
+    global PROFILE, profile_loaded
+
+    if value is not None:
+        if value != "DEFAULT" and not config.has_section(value):
+            raise click.BadParameter(f"No [{value}] section in {config_path}")
+
+        PROFILE = value
+        profile_loaded = False
+
+    return value
+
+
+@contextmanager
+def profiled(output="access_instructor.pstats", top=20, memory=False):
+    """Profile the enclosed code with cProfile and optionally tracemalloc.
+
+    Threads started inside the block, such as the workers sending concurrent
+    requests, are included. Before Python 3.12 each gets its own profiler,
+    merged into the report.
+
+    Writes the stats to output and reports the top functions by cumulative
+    time, and the peak allocation and its largest sources, on stderr.
+    """
+    thread_profilers = []
+
+    # From Python 3.12 one profiler covers every thread and a second can't be started
+    per_thread = sys.version_info < (3, 12)
+
+    def profile_thread(frame, event, arg):
+        # Called on the first event in each new thread, cProfile then takes over
+        thread_profiler = cProfile.Profile()
+
+        try:
+            thread_profiler.enable()
+
+        except ValueError:
+            # Another profiler is active, leave this thread unprofiled
+            sys.setprofile(None)
+            return
+
+        thread_profilers.append(thread_profiler)
+
+    if memory:
+        tracemalloc.start()
+
+    if per_thread:
+        threading.setprofile(profile_thread)
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+
+    try:
+        yield profiler
+
+    finally:
+        profiler.disable()
+
+        if per_thread:
+            threading.setprofile(None)
+
+        if memory:
+            _, peak = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot().filter_traces(
+                [
+                    tracemalloc.Filter(False, cProfile.__file__),
+                    tracemalloc.Filter(False, tracemalloc.__file__),
+                ]
+            )
+            tracemalloc.stop()
+
+        stream = io.StringIO()
+        stats = pstats.Stats(profiler, *thread_profilers, stream=stream)
+        stats.dump_stats(output)
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(top)
+        click.echo(f"Profile written to {output}", err=True)
+        click.echo(stream.getvalue(), err=True)
+
+        if memory:
+            click.echo(f"Peak traced memory: {peak / 1024:.1f} KiB", err=True)
+            click.echo(f"Top {top} allocation sites still held:", err=True)
+            for stat in snapshot.statistics("lineno")[:top]:
+                click.echo(f"    {stat}", err=True)
 
 
 @click.group()
-def main():
+@click.option(
+    "--config-profile",
+    "-P",
+    default=None,
+    envvar="ACCESS_INSTRUCTOR_CLIENT_PROFILE",
+    callback=profile_callback,
+    expose_value=False,
+    is_eager=True,
+    help="Config file section to read API_URL, TOKEN and client settings from.",
+)
+@click.option(
+    "--profile",
+    default=False,
+    is_flag=True,
+    help="Profile the command with cProfile and report the hottest functions.",
+)
+@click.option(
+    "--profile-output",
+    default="access_instructor.pstats",
+    type=click.Path(dir_okay=False, writable=True),
+    help="File to write the profile stats to.",
+)
+@click.option(
+    "--profile-top",
+    default=20,
+    type=click.IntRange(1),
+    help="Number of functions and allocation sites to report.",
+)
+@click.option(
+    "--profile-memory",
+    default=False,
+    is_flag=True,
+    help="Also trace memory allocations with tracemalloc.",
+)
+@click.pass_context
+def main(ctx, profile, profile_output, profile_top, profile_memory):
     """Command line tool for interacting with the access instructor."""
-    pass
+    if profile or profile_memory:
+        ctx.with_resource(profiled(profile_output, profile_top, profile_memory))
+
+
+def check_endpoints():
+    """Probe each endpoint once, marking those that don't respond as down"""
+
+    def probe(endpoint):
+        try:
+            response = session.get(
+                f"{endpoint['url']}{HEALTH_PATH}", timeout=CONNECT_TIMEOUT
+            )
+            healthy = response.status_code < 500
+            advertised_encodings.update(response_encodings(response))
+
+        except requests.RequestException:
+            healthy = False
+
+        if not healthy:
+            with endpoints_lock:
+                endpoint["down_until"] = time.monotonic() + ENDPOINT_COOLDOWN
+
+    with ThreadPoolExecutor(max_workers=len(endpoints)) as executor:
+        list(executor.map(probe, list(endpoints)))
+
+
+def check_endpoints_once():
+    """Probe the endpoints on first use, other threads carry on rather than wait"""
+    global endpoints_checked
+
+    if endpoints_checked or not endpoints_check_lock.acquire(blocking=False):
+        return
+
+    try:
+        if not endpoints_checked and len(endpoints) > 1:
+            check_endpoints()
+
+        endpoints_checked = True
+
+    finally:
+        endpoints_check_lock.release()
+
+
+def acquire_endpoint(tried):
+    """Pick the untried endpoint with the fewest outstanding requests, then the lowest latency"""
+    check_endpoints_once()
+
+    with endpoints_lock:
+        untried = [endpoint for endpoint in endpoints if endpoint["url"] not in tried]
+
+        if not untried:
+            return None
+
+        # If every endpoint is down try them anyway rather than failing outright
+        now = time.monotonic()
+        healthy = [endpoint for endpoint in untried if endpoint["down_until"] <= now]
+
+        endpoint = min(
+            healthy or untried,
+            key=lambda endpoint: (endpoint["outstanding"], endpoint["latency"]),
+        )
+        endpoint["outstanding"] += 1
+
+        return endpoint
+
+
+def release_endpoint(endpoint, elapsed=None):
+    """Record the outcome of a request, an elapsed time of None marks the endpoint down"""
+    with endpoints_lock:
+        endpoint["outstanding"] -= 1
+
+        if elapsed is None:
+            endpoint["down_until"] = time.monotonic() + ENDPOINT_COOLDOWN
+
+        else:
+            endpoint["down_until"] = 0.0
+            endpoint["latency"] = (
+                0.8 * endpoint["latency"] + 0.2 * elapsed
+                if endpoint["latency"]
+                else elapsed
+            )
+
+
+def request_not_sent(error):
+    """Whether a request failed before reaching the server, so any request can be resent"""
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+
+    return isinstance(error, requests.ConnectTimeout) or isinstance(
+        reason, NewConnectionError
+    )
+
+
+def encode_paths(paths):
+    """Front-code paths as sorted [shared prefix length, suffix] pairs"""
+    encoded = []
+    previous = ""
+
+    for path in sorted(paths):
+        prefix_length = len(os.path.commonprefix([previous, path]))
+        encoded.append([prefix_length, path[prefix_length:]])
+        previous = path
+
+    return encoded
+
+
+def response_encodings(response):
+    """Request encodings a response advertises in Accept-Encoding / Accept-Paths-Encoding"""
+    return {
+        coding.split(";")[0].strip()
+        for header in ("Accept-Encoding", "Accept-Paths-Encoding")
+        for coding in response.headers.get(header, "").split(",")
+        if coding.strip()
+    }
+
+
+def encode_request(data):
+    """Serialise request data using the configured encodings the server has advertised"""
+    headers = {"Content-Type": "application/json", "Accept-Encoding": ACCEPT_ENCODING}
+    paths = data.get("paths")
+
+    if (
+        PATH_ENCODING == "front-coded"
+        and PATH_ENCODING in advertised_encodings
+        and isinstance(paths, list)
+        and len(paths) > 1
+    ):
+        data = {**data, "paths": encode_paths(paths), "paths_encoding": PATH_ENCODING}
+
+    body = json.dumps(data, separators=(",", ":")).encode()
+
+    if (
+        COMPRESSION in COMPRESSORS
+        and COMPRESSION in advertised_encodings
+        and len(body) >= COMPRESS_MIN_BYTES
+    ):
+        body = COMPRESSORS[COMPRESSION](body)
+        headers["Content-Encoding"] = COMPRESSION
+
+    return body, headers, data.get("paths_encoding")
+
+
+def api_post(endpoint, data, auth=False):
+    """Post data as JSON to an API endpoint, compressing large request bodies.
+
+    Requests are sent to the least busy healthy replica and failed over to the
+    others when that is safe for the endpoint.
+    """
+    ensure_profile()
+    body, headers, paths_encoding = encode_request(data)
+
+    if auth:
+        if not TOKEN:
+            raise click.ClickException(f"No TOKEN for profile [{PROFILE}] in {config_path}")
+
+        headers["Authorization"] = f"Token {TOKEN}"
+
+    idempotent = endpoint in IDEMPOTENT_ENDPOINTS
+    tried = set()
+    error = None
+
+    while target := acquire_endpoint(tried):
+        tried.add(target["url"])
+        start = time.monotonic()
+
+        try:
+            response = session.post(
+                f"{target['url']}{endpoint}",
+                data=body,
+                headers=headers,
+                timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
+            )
+
+        except requests.RequestException as request_error:
+            release_endpoint(target)
+
+            if not (idempotent or request_not_sent(request_error)):
+                raise
+
+            error = request_error
+            continue
+
+        if response.status_code in RETRY_STATUSES:
+            release_endpoint(target)
+
+            # 503 means the request was refused, so it is safe to resend anything
+            if (idempotent or response.status_code == 503) and len(tried) < len(endpoints):
+                continue
+
+        else:
+            release_endpoint(target, time.monotonic() - start)
+
+        break
+
+    else:
+        raise error or click.ClickException("No API endpoints configured")
+
+    accepted = response_encodings(response)
+
+    if response.status_code == 415:
+        # Forget whichever encodings the server no longer advertises and retry
+        rejected = {headers.get("Content-Encoding"), paths_encoding} - {None} - accepted
+
+        if rejected:
+            advertised_encodings.difference_update(rejected)
+            return api_post(endpoint, data, auth=auth)
+
+    advertised_encodings.update(accepted)
+
+    if response.ok and endpoint in RULE_WRITE_ENDPOINTS:
+        # The expiry snapshot may no longer match the rules on the server
+        invalidate_expiry_index()
+
+    return response
+
+
+def post_concurrently(endpoint, payloads, workers=8, label="Sending"):
+    """Post each payload to an endpoint concurrently, returning (payload, error) failures"""
+    failures = []
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(api_post, endpoint, payload, auth=True): payload
+            for payload in payloads
+        }
+
+        with click.progressbar(as_completed(futures), length=len(futures), label=label) as bar:
+            for future in bar:
+                payload = futures[future]
+
+                try:
+                    response = future.result()
+
+                except requests.RequestException as error:
+                    failures.append((payload, str(error)))
+                    continue
+
+                if not response.ok:
+                    failures.append(
+                        (payload, f"status code: {response.status_code}, reason: {response.reason}")
+                    )
+
+    return failures
+
+
+def expand_path(path, fallback=True):
+    """Expand a glob pattern, optionally falling back to the literal path if nothing matches"""
+    if not has_magic(path):
+        return [path]
+
+    paths = glob(path, recursive=True)
+
+    # A trailing ** also matches its own base directory, which the pattern
+    # doesn't name and which would widen removals and collapses to the parent
+    pattern = path.rstrip("/")
+    if pattern == "**" or pattern.endswith("/**"):
+        base = os.path.normpath(pattern[:-2] or ".")
+        paths = [match for match in paths if os.path.normpath(match) != base]
+
+    if not paths and fallback:
+        paths.append(path)
+
+    return paths
+
+
+def normalise_paths(paths, collapse=False):
+    """Canonicalise and dedupe paths, optionally dropping paths below another given path.
+
+    Returns the sorted paths and a dict of each kept path to the paths it covers.
+    """
+    # Sort by component so a parent is directly followed by its children
+    paths = sorted({os.path.normpath(path) for path in paths}, key=lambda p: p.split("/"))
+    collapsed = {}
+
+    if not collapse:
+        return paths, collapsed
+
+    kept = []
+    for path in paths:
+        if kept and path.startswith(kept[-1].rstrip("/") + "/"):
+            collapsed.setdefault(kept[-1], []).append(path)
+
+        else:
+            kept.append(path)
+
+    return kept, collapsed
+
+
+def report_collapsed(collapsed):
+    """Display paths that were dropped because a parent path covers them"""
+    if collapsed:
+        click.echo(
+            f"Collapsed {sum(len(paths) for paths in collapsed.values())} paths covered by {len(collapsed)} parent paths:"
+        )
+
+        for parent, paths in collapsed.items():
+            click.echo(f"    {parent} covers {len(paths)} paths")
 
 
 def display_rules(response, sub=True):
@@ -66,6 +619,61 @@ def echo_rules(rules):
         )
 
 
+def rule_filters(
+    path,
+    rule_type,
+    group,
+    expiry_date,
+    comment,
+    licence_code,
+    licence_category,
+    collapse=True,
+):
+    """Build the /rule/find request data for the given filters.
+
+    Only collapse paths below another matched path if sub rules will be used.
+    """
+
+    data = {}
+
+    if rule_type:
+        data["rule_type"] = rule_type
+
+    if group:
+        data["group"] = group
+
+    if expiry_date:
+        data["expiry_date"] = expiry_date.strftime("%Y-%m-%d")
+
+    if comment:
+        data["comment"] = comment
+
+    if licence_code:
+        data["licence_code"] = licence_code
+
+    if licence_category:
+        data["licence_category"] = licence_category
+
+    if path:
+        data["paths"], collapsed = normalise_paths(expand_path(path), collapse=collapse)
+        report_collapsed(collapsed)
+
+    return data
+
+
+def found_rules(response, sub=True):
+    """Flatten a /rule/find response to a list of unique rules"""
+    if "path_rules" not in response:
+        return response
+
+    rules = {}
+    for path_rules in response["path_rules"].values():
+        for rule in path_rules["rules"] + (path_rules["sub_rules"] if sub else []):
+            rules[rule["id"]] = rule
+
+    return list(rules.values())
+
+
 @main.command()
 @click.option(
     "--path",
@@ -117,37 +725,12 @@ def list_rule(
 ):
     """List Rules that match given parameters"""
 
-    data = {}
-
-    if rule_type:
-        data["rule_type"] = rule_type
-
-    if group:
-        data["group"] = group
-
-    if expiry_date:
-        data["expiry_date"] = expiry_date.strftime("%Y-%m-%d")
-
-    if comment:
-        data["comment"] = comment
-
-    if licence_code:
-        data["licence_code"] = licence_code
-
-    if licence_category:
-        data["licence_category"] = licence_category
-
-    if path:
-        paths = []
-        for glob_path in glob(path):
-            paths.append(glob_path)
-
-        if not paths:
-            paths.append(path)
-
-        data["paths"] = paths
+    # Sub rules are displayed, so children of a listed path are covered
+    data = rule_filters(
+        path, rule_type, group, expiry_date, comment, licence_code, licence_category
+    )
 
-    response = requests.post(f"{API_URL}/rule/find", json=data)
+    response = api_post("/rule/find", data)
 
     if response.ok:
         display_rules(response.json())
@@ -187,16 +770,13 @@ def run_rules(path, allow_sub_rules=False, force=False):
     data = {}
 
     if path:
-        glob_paths = []
-        for glob_path in glob(path):
-            glob_paths.append(glob_path)
-
-        if not glob_paths:
-            glob_paths.append(path)
-
-        data["paths"] = glob_paths
+        # Children are only covered when their parent's sub rules are run too
+        data["paths"], collapsed = normalise_paths(
+            expand_path(path), collapse=allow_sub_rules
+        )
+        report_collapsed(collapsed)
 
-    response = requests.post(f"{API_URL}/rule/find", json=data)
+    response = api_post("/rule/find", data)
 
     if not response.ok:
         click.echo(
@@ -242,7 +822,7 @@ def run_rules(path, allow_sub_rules=False, force=False):
         rule_path = rule["path"]
         click.echo(f"Running {rule_id} ({rule_path})")
 
-        response = requests.post(f"{API_URL}/rule/run", json={"id": rule_id}, headers={"Authorization": f"Token {TOKEN}"})
+        response = api_post("/rule/run", {"id": rule_id}, auth=True)
 
         if not response.ok:
             click.echo(
@@ -292,7 +872,16 @@ def run_rules(path, allow_sub_rules=False, force=False):
     is_flag=True,
     help="Will display existing rules before creation of new rules",
 )
-def add_rule(path, rule_type, group, expiry_date, comment, licence_code, check):
+@click.option(
+    "--collapse",
+    "-m",
+    default=False,
+    is_flag=True,
+    help="Only create rules for the top-most matching paths, their children inherit them",
+)
+def add_rule(
+    path, rule_type, group, expiry_date, comment, licence_code, check, collapse
+):
     """Create Rules with given parameters"""
 
     data = {
@@ -308,15 +897,13 @@ def add_rule(path, rule_type, group, expiry_date, comment, licence_code, check):
         click.echo("Group rules must have a group(-g)")
         sys.exit()
 
-    if any(wildcard in path for wildcard in punctuation.replace("/", "")):
-        for glob_path in glob(path):
-            data["paths"].append(glob_path)
-
-    else:
-        data["paths"].append(path)
+    data["paths"], collapsed = normalise_paths(
+        expand_path(path, fallback=False), collapse=collapse
+    )
+    report_collapsed(collapsed)
 
     if check:
-        response = requests.post(f"{API_URL}/rule/find", json={"paths": data["paths"]})
+        response = api_post("/rule/find", {"paths": data["paths"]})
 
         if response.ok:
             display_rules(response.json())
@@ -335,9 +922,7 @@ def add_rule(path, rule_type, group, expiry_date, comment, licence_code, check):
     if not click.confirm("Do you want to continue?"):
         sys.exit()
 
-    response = requests.post(
-        f"{API_URL}/rule/add", json=data, headers={"Authorization": f"Token {TOKEN}"}
-    )
+    response = api_post("/rule/add", data, auth=True)
 
     if response.ok:
         click.echo(
@@ -352,6 +937,69 @@ def add_rule(path, rule_type, group, expiry_date, comment, licence_code, check):
         click.echo(f"{response.text}")
 
 
+def rule_changes(
+    rule_type, group, expiry_date, comment, licence_code, options=("-t", "-g")
+):
+    """Build the fields to update from the given options, leaving out unset ones.
+
+    options are the type and group flags to name in error messages.
+    """
+    type_option, group_option = options
+
+    if rule_type == "G" and not group:
+        click.echo(f"Group rules must have a group({group_option})")
+        sys.exit()
+
+    elif group and rule_type != "G":
+        click.echo(
+            f"Only group rules have a specified group({group_option}), use {type_option} G"
+        )
+        sys.exit()
+
+    changes = {}
+
+    if rule_type:
+        changes["rule_type"] = rule_type
+
+    if group:
+        changes["group"] = group
+
+    if expiry_date:
+        changes["expiry_date"] = expiry_date.strftime("%Y-%m-%d")
+
+    if comment is not None:
+        changes["comment"] = comment
+
+    if licence_code:
+        changes["licence_code"] = licence_code
+
+    return changes
+
+
+def rule_values(rule):
+    """Current values of a found rule, keyed as in update requests"""
+    return {
+        "rule_type": rule["rule_type"],
+        "group": rule["group"]["name"] if rule.get("group") else None,
+        "expiry_date": rule["expiry_date"][:10] if rule["expiry_date"] else None,
+        "comment": rule.get("comment", ""),
+        "licence_code": rule["licence"].get("code") if rule["licence"] else None,
+    }
+
+
+def rule_patch(rule, changes):
+    """Sparse update request for a rule containing only the fields that differ"""
+    values = rule_values(rule)
+    patch = {
+        field: value for field, value in changes.items() if values[field] != value
+    }
+
+    if patch:
+        patch["rule"] = rule["id"]
+
+    return patch
+
+
 @main.command()
 @click.option(
     "--rule",
@@ -383,7 +1031,7 @@ def add_rule(path, rule_type, group, expiry_date, comment, licence_code, check):
     type=click.DateTime(formats=["%Y-%m-%d"]),
     help="Date rule will expire on. Format: YYY-MM-DD.",
 )
-@click.option("--comment", "-c", default="", help="Any comments to help traceability.")
+@click.option("--comment", "-c", default=None, help="Any comments to help traceability.")
 @click.option(
     "--licence",
     "-l",
@@ -403,26 +1051,16 @@ def update_rule(
 ):
     """Updates a Rule of the given id with given parameters"""
 
-    data = {
-        "rule": rule,
-        "path": path,
-        "rule_type": rule_type,
-        "group": group,
-        "expiry_date": expiry_date.strftime("%Y-%m-%d") if expiry_date else expiry_date,
-        "comment": comment,
-        "licence_code": licence_code,
-    }
+    # Only send the fields being changed so the others are left untouched
+    data = {"rule": rule}
 
-    if rule_type == "G" and not group:
-        click.echo("Group rules must have a group(-g)")
-        sys.exit()
+    if path:
+        data["path"] = path
 
-    elif group:
-        click.echo("Only group rules have a specified group(-g)")
-        sys.exit()
+    data.update(rule_changes(rule_type, group, expiry_date, comment, licence_code))
 
-    if check:
-        response = requests.post(f"{API_URL}/rule/find", json={"paths": data["path"]})
+    if check and path:
+        response = api_post("/rule/find", {"paths": [path]})
 
         if response.ok:
             display_rules(response.json())
@@ -433,11 +1071,7 @@ def update_rule(
             )
             click.echo(f"{response.text}")
 
-    response = requests.post(
-        f"{API_URL}/rule/update",
-        json=data,
-        headers={"Authorization": f"Token {TOKEN}"},
-    )
+    response = api_post("/rule/update", data, auth=True)
 
     if response.ok:
         click.echo(f"Successfully updated rule: {rule}")
@@ -450,6 +1084,177 @@ def update_rule(
         click.echo(f"{response.text}")
 
 
+@main.command()
+@click.option(
+    "--path",
+    "-p",
+    "path",
+    default=None,
+    help="Path to select rules for.",
+)
+@click.option(
+    "--type",
+    "-t",
+    "rule_type",
+    default=None,
+    type=click.Choice(["N", "P", "R", "G"]),
+    help="Select rules of this type.",
+)
+@click.option("--group", "-g", default=None, help="Select rules for this group.")
+@click.option(
+    "--expiry_date",
+    "-e",
+    default=None,
+    type=click.DateTime(formats=["%Y-%m-%d"]),
+    help="Select rules expiring on this date. Format: YYYY-MM-DD.",
+)
+@click.option("--comment", "-c", default="", help="Select rules with this comment.")
+@click.option(
+    "--licence",
+    "-l",
+    "licence_code",
+    default=None,
+    help="Select rules with this licence code.",
+)
+@click.option(
+    "--licence-cat",
+    "-k",
+    "licence_category",
+    default=None,
+    multiple=True,
+    help="Select rules with this licence category.",
+)
+@click.option(
+    "--set-type",
+    "-T",
+    "new_rule_type",
+    default=None,
+    type=click.Choice(["N", "P", "R", "G"]),
+    help='New rule type. Either: No access "N", Public "P", Registered User "R" or Group "G".',
+)
+@click.option("--set-group", "-G", "new_group", default=None, help="New group name to be given access.")
+@click.option(
+    "--set-expiry_date",
+    "-E",
+    "new_expiry_date",
+    default=None,
+    type=click.DateTime(formats=["%Y-%m-%d"]),
+    help="New expiry date. Format: YYYY-MM-DD.",
+)
+@click.option("--set-comment", "-C", "new_comment", default=None, help="New comment.")
+@click.option(
+    "--set-licence",
+    "-L",
+    "new_licence_code",
+    default=None,
+    help="New licence code.",
+)
+@click.option(
+    "--allow-sub-rules",
+    "-a",
+    default=False,
+    is_flag=True,
+    help="Update sub rules of the selected paths as well",
+)
+@click.option(
+    "--workers",
+    default=8,
+    type=click.IntRange(1),
+    help="Number of concurrent update requests",
+)
+@click.option(
+    "--force",
+    "-f",
+    default=False,
+    is_flag=True,
+    help="Skips the confirmation step",
+)
+def update_rules(
+    path,
+    rule_type,
+    group,
+    expiry_date,
+    comment,
+    licence_code,
+    licence_category,
+    new_rule_type,
+    new_group,
+    new_expiry_date,
+    new_comment,
+    new_licence_code,
+    allow_sub_rules,
+    workers,
+    force,
+):
+    """Updates all Rules matching the given filters with the given new values"""
+
+    changes = rule_changes(
+        new_rule_type,
+        new_group,
+        new_expiry_date,
+        new_comment,
+        new_licence_code,
+        options=("-T", "-G"),
+    )
+
+    if not changes:
+        click.echo("No new values given, use the --set-* options")
+        sys.exit()
+
+    # Children are only covered when their parent's sub rules are updated too
+    data = rule_filters(
+        path,
+        rule_type,
+        group,
+        expiry_date,
+        comment,
+        licence_code,
+        licence_category,
+        collapse=allow_sub_rules,
+    )
+
+    response = api_post("/rule/find", data)
+
+    if not response.ok:
+        click.echo(
+            f"Error. status code: {response.status_code}, reason: {response.reason}"
+        )
+        click.echo(f"{response.text}")
+        sys.exit()
+
+    rules = found_rules(response.json(), sub=allow_sub_rules)
+    patches = [patch for rule in rules if (patch := rule_patch(rule, changes))]
+
+    if not patches:
+        click.echo(f"{len(rules)} rules found, none need updating")
+        sys.exit()
+
+    # Summarise the changes by field rather than listing every rule
+    values = {rule["id"]: rule_values(rule) for rule in rules}
+    diff = Counter(
+        (field, values[patch["rule"]][field], value)
+        for patch in patches
+        for field, value in patch.items()
+        if field != "rule"
+    )
+
+    click.echo(f"{len(rules)} rules found, {len(patches)} will be updated:")
+    for (field, old, new), count in sorted(diff.items(), key=str):
+        click.echo(f"    {field}: {old} -> {new} ({count} rules)")
+
+    if not force and not click.confirm("Do you want to continue?"):
+        sys.exit()
+
+    failures = post_concurrently(
+        "/rule/update", patches, workers=workers, label="Updating rules"
+    )
+
+    for patch, error in failures:
+        click.echo(f"Failed to update rule {patch['rule']}. {error}")
+
+    click.echo(f"Successfully updated {len(patches) - len(failures)} rules")
+
+
 @main.command()
 @click.option(
     "--path", "-p", "path", help="Path for directory rule will be applied to."
@@ -504,15 +1309,11 @@ def remove_rule(path, rule_type, group, expiry_date, comment, licence_code, chec
     if licence_code:
         data["licence_code"] = licence_code
 
-    if any(wildcard in path for wildcard in punctuation.replace("/", "")):
-        for glob_path in glob(path):
-            data["paths"].append(glob_path)
-
-    else:
-        data["paths"].append(path)
+    # Removal is per path, so only exact duplicates can be dropped
+    data["paths"], _ = normalise_paths(expand_path(path, fallback=False))
 
     if check:
-        response = requests.post(f"{API_URL}/rule/find", json=data)
+        response = api_post("/rule/find", data)
 
         if response.ok:
             display_rules(response.json(), sub=False)
@@ -530,9 +1331,7 @@ def remove_rule(path, rule_type, group, expiry_date, comment, licence_code, chec
     if not click.confirm("Do you want to continue?"):
         sys.exit()
 
-    response = requests.post(
-        f"{API_URL}/rule/remove", json=data, headers={"Authorization": f"Token {TOKEN}"}
-    )
+    response = api_post("/rule/remove", data, auth=True)
 
     if response.ok:
         click.echo(f"Deleted: all rules for paths [{', '.join(data['paths'])}]")
@@ -544,6 +1343,184 @@ def remove_rule(path, rule_type, group, expiry_date, comment, licence_code, chec
         click.echo(f"{response.text}")
 
 
+def duration_callback(ctx, param, value):
+    """Convert durations such as 30d or 6w to a timedelta"""
+    units = {"d": 1, "w": 7}
+
+    try:
+        if value[-1] in units:
+            return timedelta(days=int(value[:-1]) * units[value[-1]])
+
+        return timedelta(days=int(value))
+
+    except (ValueError, IndexError):
+        raise click.BadParameter("Expected a number of days or weeks, e.g. 30d or 6w")
+
+
+def save_expiry_index(rules, fetched=None):
+    """Save rules with an expiry date to the local cache, ordered by expiry date"""
+    rules = sorted(
+        (rule for rule in rules if rule["expiry_date"]),
+        key=lambda rule: rule["expiry_date"],
+    )
+    index = {
+        "fetched": fetched or datetime.now().isoformat(),
+        "expiry_dates": [rule["expiry_date"][:10] for rule in rules],
+        "rules": rules,
+    }
+
+    os.makedirs(os.path.dirname(RULE_CACHE), exist_ok=True)
+    with open(RULE_CACHE, "w") as cache_file:
+        json.dump(index, cache_file)
+
+    return index
+
+
+def invalidate_expiry_index():
+    """Delete the local expiry snapshot so the next expiring command refetches rules"""
+    try:
+        os.remove(RULE_CACHE)
+
+    except FileNotFoundError:
+        pass
+
+
+def load_expiry_index(refresh=False):
+    """Load the expiry index from the local cache, fetching all rules if it is missing or stale"""
+    ensure_profile()
+
+    if not refresh and os.path.exists(RULE_CACHE):
+        with open(RULE_CACHE) as cache_file:
+            index = json.load(cache_file)
+
+        if datetime.now() - datetime.fromisoformat(index["fetched"]) < RULE_CACHE_MAX_AGE:
+            return index
+
+    response = api_post("/rule/find", {})
+
+    if not response.ok:
+        click.echo(
+            f"Error. status code: {response.status_code}, reason: {response.reason}"
+        )
+        click.echo(f"{response.text}")
+        sys.exit()
+
+    return save_expiry_index(response.json())
+
+
+def rules_expiring(index, start, end):
+    """Rules in the index expiring between the start and end dates inclusive"""
+    dates = index["expiry_dates"]
+    first = bisect_left(dates, start.isoformat()) if start else 0
+
+    return index["rules"][first : bisect_right(dates, end.isoformat())]
+
+
+@main.command()
+@click.option(
+    "--within",
+    "-w",
+    default="30d",
+    callback=duration_callback,
+    help="Find rules expiring within this many days or weeks, e.g. 30d or 6w.",
+)
+@click.option(
+    "--expired",
+    "-x",
+    default=False,
+    is_flag=True,
+    help="Include rules that have already expired",
+)
+@click.option(
+    "--refresh",
+    "-r",
+    default=False,
+    is_flag=True,
+    help="Refetch rules instead of using the cached snapshot",
+)
+@click.option(
+    "--renew",
+    "-n",
+    "renew_date",
+    default=None,
+    type=click.DateTime(formats=["%Y-%m-%d"]),
+    help="Set the expiry date of the matching rules to this date. Format: YYYY-MM-DD.",
+)
+@click.option(
+    "--run",
+    default=False,
+    is_flag=True,
+    help="Run the pipeline for the matching rules",
+)
+@click.option(
+    "--workers",
+    default=8,
+    type=click.IntRange(1),
+    help="Number of concurrent requests when renewing or running rules",
+)
+@click.option(
+    "--force",
+    "-f",
+    default=False,
+    is_flag=True,
+    help="Skips the confirmation step",
+)
+def expiring(within, expired, refresh, renew_date, run, workers, force):
+    """List Rules expiring soon, optionally renewing or running them"""
+
+    index = load_expiry_index(refresh)
+    today = date.today()
+    rules = rules_expiring(index, None if expired else today, today + within)
+
+    if not rules:
+        click.echo(f"No rules expiring by {today + within}")
+        sys.exit()
+
+    click.echo(f"{len(rules)} rules expiring by {today + within}:")
+    click.echo("ID : Path : Type : Group : Licence : Expiry date")
+    echo_rules(rules)
+
+    if not (renew_date or run):
+        sys.exit()
+
+    if not force:
+        action = f"renew until {renew_date:%Y-%m-%d}" if renew_date else "run the pipeline for"
+        click.echo(f"This will {action} {len(rules)} rules")
+        if not click.confirm("Do you want to continue?"):
+            sys.exit()
+
+    failures = []
+
+    if renew_date:
+        failures += post_concurrently(
+            "/rule/update",
+            [{"rule": rule["id"], "expiry_date": f"{renew_date:%Y-%m-%d}"} for rule in rules],
+            workers=workers,
+            label="Renewing rules",
+        )
+
+        # Keep the snapshot in step with the renewed rules
+        renewed = {rule["id"] for rule in rules} - {payload["rule"] for payload, _ in failures}
+        for rule in index["rules"]:
+            if rule["id"] in renewed:
+                rule["expiry_date"] = f"{renew_date:%Y-%m-%d}"
+
+        save_expiry_index(index["rules"], index["fetched"])
+
+    if run:
+        failures += post_concurrently(
+            "/rule/run",
+            [{"id": rule["id"]} for rule in rules],
+            workers=workers,
+            label="Running rules",
+        )
+
+    for payload, error in failures:
+        click.echo(f"Failed {payload}. {error}")
+
+    click.echo("Finished")
+
+
 def display_licences(licences):
     """display licences in readable format"""
     for licence in licences:
@@ -591,7 +1568,7 @@ def list_licence(code, title, url, category_tags):
     if category_tags:
         data["category_tags"] = category_tags
 
-    response = requests.post(f"{API_URL}/licence/find", json=data)
+    response = api_post("/licence/find", data)
 
     if response.ok:
         licences = response.json()
@@ -636,9 +1613,7 @@ def add_licence(code, title, url, comment, category_tags):
         "category_tags": category_tags,
     }
 
-    response = requests.post(
-        f"{API_URL}/licence/add", json=data, headers={"Authorization": f"Token {TOKEN}"}
-    )
+    response = api_post("/licence/add", data, auth=True)
 
     if response.ok:
         click.echo(f"Successfully created licence {code} : {title}")
@@ -693,7 +1668,7 @@ def remove_licence(code, title, url, comment, category_tags, check):
         data["category_tags"] = category_tags
 
     if check:
-        response = requests.post(f"{API_URL}/licence/find", json=data)
+        response = api_post("/licence/find", data)
 
         if response.ok:
             licences = response.json()
@@ -711,7 +1686,7 @@ def remove_licence(code, title, url, comment, category_tags, check):
             click.echo(f"{response.text}")
             sys.exit()
 
-    response = requests.post(f"{API_URL}/licence/remove", json=data)
+    response = api_post("/licence/remove", data)
 
     if response.ok:
         click.echo(f"Successfully removed licence {code} : {title}")
@@ -748,7 +1723,7 @@ def fix_unix_permissions(path, force=False):
         if not click.confirm("Do you want to continue?"):
             sys.exit()
 
-    response = requests.post(f"{API_URL}/path/unixupdate", json={"path": path}, headers={"Authorization": f"Token {TOKEN}"})
+    response = api_post("/path/unixupdate", {"path": path}, auth=True)
 
     if not response.ok:
         click.echo(
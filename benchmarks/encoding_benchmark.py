@@ -0,0 +1,132 @@
+"""Measure request payload size and latency for each request encoding.
+
+Builds a CMIP6 style path set and posts it to /rule/find with plain JSON,
+front-coded paths, compression and both. By default the requests go to a
+local server that decodes them as a real one would. Pass --api-url to time
+a deployed API instead, /rule/find is read only.
+
+    $ python benchmarks/encoding_benchmark.py
+    $ python benchmarks/encoding_benchmark.py --api-url https://host/api/v1
+"""
+import argparse
+import gzip
+import json
+import os
+import statistics
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+MODES = [
+    ("plain", "none", "plain"),
+    ("front-coded", "none", "front-coded"),
+    ("gzip", "gzip", "plain"),
+    ("front-coded + gzip", "gzip", "front-coded"),
+    ("zstd", "zstd", "plain"),
+    ("front-coded + zstd", "zstd", "front-coded"),
+]
+
+
+def cmip6_paths():
+    """1,200 paths shaped like CEDA's CMIP6 archive"""
+    return [
+        f"/badc/cmip6/data/CMIP6/{mip}/{institution}/{model}/{experiment}/r{member}i1p1f1/{table}/{variable}/gn/latest"
+        for mip, institution, model in [
+            ("CMIP", "MOHC", "HadGEM3-GC31-LL"),
+            ("ScenarioMIP", "MOHC", "UKESM1-0-LL"),
+        ]
+        for experiment in ["historical", "ssp245", "ssp585", "piControl"]
+        for member in range(1, 6)
+        for table in ["Amon", "Omon", "day"]
+        for variable in ["tas", "pr", "psl", "uas", "vas", "tos", "zg", "ua", "va", "hus"]
+    ]
+
+
+class DecodingHandler(BaseHTTPRequestHandler):
+    """Decompresses and decodes request bodies, advertising every encoding"""
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        encoding = self.headers.get("Content-Encoding")
+
+        if encoding == "gzip":
+            body = gzip.decompress(body)
+
+        elif encoding == "zstd":
+            import zstandard
+
+            body = zstandard.ZstdDecompressor().decompress(body)
+
+        data = json.loads(body)
+
+        if data.get("paths_encoding") == "front-coded":
+            paths, previous = [], ""
+            for prefix_length, suffix in data["paths"]:
+                previous = previous[:prefix_length] + suffix
+                paths.append(previous)
+
+        self.send_response(200)
+        self.send_header("Accept-Encoding", "gzip, zstd")
+        self.send_header("Accept-Paths-Encoding", "front-coded")
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"[]")
+
+    def log_message(self, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--api-url", help="API to time instead of a local server")
+    parser.add_argument("--repeat", type=int, default=50, help="Requests per encoding")
+    args = parser.parse_args()
+
+    api_url = args.api_url
+
+    if not api_url:
+        server = ThreadingHTTPServer(("127.0.0.1", 0), DecodingHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        api_url = f"http://127.0.0.1:{server.server_port}/api/v1"
+
+    with tempfile.NamedTemporaryFile("w", suffix=".ini", delete=False) as config_file:
+        config_file.write(f"[DEFAULT]\nAPI_URL = {api_url}\nTOKEN = unused\n")
+
+    os.environ["ACCESS_INSTRUCTOR_CLIENT_CONFIG_FILE"] = config_file.name
+    from access_instructor import access_instructor as client
+
+    data = {"paths": cmip6_paths()}
+    print(f"{len(data['paths'])} paths, {args.repeat} requests each, {api_url}")
+    print(f"{'encoding':<20} {'bytes':>8} {'median ms':>10} {'p90 ms':>8}")
+
+    for name, compression, path_encoding in MODES:
+        if compression not in ("none", *client.COMPRESSORS):
+            print(f"{name:<20} skipped, not installed")
+            continue
+
+        client.config["DEFAULT"]["COMPRESSION"] = compression
+        client.config["DEFAULT"]["PATH_ENCODING"] = path_encoding
+        client.config["DEFAULT"]["COMPRESS_MIN_BYTES"] = "0"
+        client.load_profile("DEFAULT")
+
+        # The first response advertises the encodings the server accepts
+        client.api_post("/rule/find", {})
+        body, _, _ = client.encode_request(data)
+
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            client.api_post("/rule/find", data)
+            timings.append((time.perf_counter() - start) * 1000)
+
+        print(
+            f"{name:<20} {len(body):>8} {statistics.median(timings):>10.2f} "
+            f"{statistics.quantiles(timings, n=10)[-1]:>8.2f}"
+        )
+
+    os.remove(config_file.name)
+
+
+if __name__ == "__main__":
+    main()
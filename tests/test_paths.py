@@ -0,0 +1,86 @@
+import os
+
+import pytest
+
+from access_instructor.access_instructor import expand_path, normalise_paths
+
+
+@pytest.fixture
+def tree(tmp_path):
+    for directory in ["x/a/b", "x/c", "x-y"]:
+        (tmp_path / directory).mkdir(parents=True)
+
+    return tmp_path
+
+
+def test_expand_path_without_magic(tree):
+    path = f"{tree}/x_y.nc"
+
+    assert expand_path(path) == [path]
+    assert expand_path(path, fallback=False) == [path]
+
+
+def test_expand_path_no_matches(tree):
+    assert expand_path(f"{tree}/z*") == [f"{tree}/z*"]
+    assert expand_path(f"{tree}/z*", fallback=False) == []
+
+
+def test_expand_path_recursive_excludes_base(tree):
+    paths = normalise_paths(expand_path(f"{tree}/x/**"))[0]
+
+    assert paths == [f"{tree}/x/a", f"{tree}/x/a/b", f"{tree}/x/c"]
+
+
+def test_expand_path_recursive_trailing_slash(tree):
+    paths = normalise_paths(expand_path(f"{tree}/x/**/"))[0]
+
+    assert paths == [f"{tree}/x/a", f"{tree}/x/a/b", f"{tree}/x/c"]
+
+
+def test_expand_path_relative(tree, monkeypatch):
+    monkeypatch.chdir(tree / "x")
+
+    assert normalise_paths(expand_path("**"))[0] == ["a", "a/b", "c"]
+    assert normalise_paths(expand_path("a/**"))[0] == ["a/b"]
+
+
+def test_normalise_paths_dedupes_and_canonicalises():
+    paths, collapsed = normalise_paths(["/a/b/", "/a/./b", "/a//b", "/a/c/../b"])
+
+    assert paths == ["/a/b"]
+    assert collapsed == {}
+
+
+def test_normalise_paths_keeps_children_without_collapse():
+    paths, collapsed = normalise_paths(["/a/b", "/a"])
+
+    assert paths == ["/a", "/a/b"]
+    assert collapsed == {}
+
+
+def test_normalise_paths_collapses_children():
+    paths, collapsed = normalise_paths(["/a/b/c", "/a", "/a/b", "/d"], collapse=True)
+
+    assert paths == ["/a", "/d"]
+    assert collapsed == {"/a": ["/a/b", "/a/b/c"]}
+
+
+def test_normalise_paths_siblings_sharing_a_prefix():
+    paths, collapsed = normalise_paths(["/a", "/a-b", "/a/b", "/ab"], collapse=True)
+
+    assert paths == ["/a", "/a-b", "/ab"]
+    assert collapsed == {"/a": ["/a/b"]}
+
+
+def test_normalise_paths_root():
+    paths, collapsed = normalise_paths(["/a", "/", "/b/c"], collapse=True)
+
+    assert paths == ["/"]
+    assert collapsed == {"/": ["/a", "/b/c"]}
+
+
+def test_normalise_paths_relative():
+    paths, collapsed = normalise_paths(["./a/b", "a", "b"], collapse=True)
+
+    assert paths == ["a", "b"]
+    assert collapsed == {"a": ["a/b"]}
@@ -0,0 +1,28 @@
+import pstats
+from concurrent.futures import ThreadPoolExecutor
+
+from access_instructor.access_instructor import profiled
+
+
+def worker_task(n):
+    return sum(range(n))
+
+
+def test_profiled_includes_worker_threads(tmp_path):
+    output = tmp_path / "threads.pstats"
+
+    with profiled(str(output), top=5):
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(worker_task, [1000] * 8, timeout=30))
+
+    assert results == [sum(range(1000))] * 8
+
+    functions = {function for _, _, function in pstats.Stats(str(output)).stats}
+    assert "worker_task" in functions
+
+
+def test_profiled_reports_memory(tmp_path, capsys):
+    with profiled(str(tmp_path / "memory.pstats"), top=5, memory=True):
+        worker_task(1000)
+
+    assert "Peak traced memory" in capsys.readouterr().err